@@ -0,0 +1,51 @@
+# modules/_alloc.py
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to the plain Python loop
+    njit = None
+
+
+def _allocate(group_starts, group_ends, surplus, need, min_qty):
+    """
+    Greedy transfer allocation over rows grouped by Key.
+
+    Rows group_starts[g]:group_ends[g] belong to one Key, in branch order.
+    Sources and destinations with at least max(min_qty, 1) units of
+    surplus / need are matched with a two-pointer walk.
+
+    Returns (src_idx, dst_idx, qty) arrays; indices refer to input rows.
+    """
+    surplus = surplus.copy()
+    need = need.copy()
+    # every transfer exhausts a source or a destination row
+    cap = surplus.size * 2
+    src_idx = np.empty(cap, dtype=np.int64)
+    dst_idx = np.empty(cap, dtype=np.int64)
+    qty = np.empty(cap, dtype=np.int64)
+    # every transfer moves at least one unit; a zero-unit step would never advance
+    min_qty = max(min_qty, 1)
+    w = 0
+    for g in range(group_starts.size):
+        i = group_starts[g]
+        j = group_starts[g]
+        end = group_ends[g]
+        while i < end and j < end:
+            if surplus[i] < min_qty:
+                i += 1
+                continue
+            if need[j] < min_qty:
+                j += 1
+                continue
+            q = min(surplus[i], need[j])
+            src_idx[w] = i
+            dst_idx[w] = j
+            qty[w] = q
+            w += 1
+            surplus[i] -= q
+            need[j] -= q
+    return src_idx[:w], dst_idx[:w], qty[:w]
+
+
+allocate = njit(cache=True)(_allocate) if njit is not None else _allocate
@@ -1,55 +1,125 @@
 # modules/processor.py
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import io
+import numpy as np
 import pandas as pd
 import re
-from typing import List, Tuple
+import streamlit as st
+from typing import List, Optional, Tuple
+
+from modules._alloc import allocate
+
+__all__ = ['process_combined_sheet', 'process_combined_sheet_cached']
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # pyarrow is optional; fall back to the pandas C parser
+    pa = pa_csv = None
+
+# calamine reads xlsx much faster than openpyxl when python-calamine is installed
+_EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else None
+
+# vectorized .str calls take pattern strings: a compiled regex bypasses the Arrow string kernels
+_NON_DIGIT_PAT = r'[^0-9]'
+_NON_DIGIT_RE = re.compile(_NON_DIGIT_PAT)
+# first instruction of a Suggested Action: "<Transfer to|Receive from> <Branch> x<QTY>"
+_INSTRUCTION_PAT = r'^(Transfer to|Receive from) (.+) x(\d+)$'
+# cell values pd.read_csv treats as missing by default (pandas' STR_NA_VALUES)
+_CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+                  '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+# barcode separators, all mapped to ',' in a single pass
+_BC_TRANS = str.maketrans({';': ',', '|': ',', '/': ',', '\\': ','})
+# a run of separators and whitespace between two barcodes; whitespace is spelled out
+# (the characters str.strip() removes) because \s is ASCII-only on Arrow (RE2) strings
+_WS_CHARS = '\t\n\x0b\x0c\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000'
+_BLANK_SEP_PAT = f'[{_WS_CHARS},]*,[{_WS_CHARS},]*'
 
 # --- helpers ---
 def split_barcodes(val: str) -> List[str]:
     if pd.isna(val) or val is None:
         return []
-    txt = str(val)
-    for sep in [';', '|', '/', '\\']:
-        txt = txt.replace(sep, ',')
-    parts = [p.strip() for p in txt.split(',') if p.strip() != '']
-    return parts
+    parts = [p.strip() for p in str(val).translate(_BC_TRANS).split(',')]
+    return [p for p in parts if p != '']
 
 def digits_only(s: str) -> str:
-    return re.sub(r'[^0-9]', '', str(s)).lstrip('0')
+    return _NON_DIGIT_RE.sub('', str(s)).lstrip('0')
 
 def normalize_key(bc: str) -> str:
     d = digits_only(bc)
     return d if d != '' else str(bc).strip().lower()
 
+def read_csv_text(f) -> pd.DataFrame:
+    """Read a CSV keeping every column as text (PyArrow parser when available)."""
+    if pa_csv is not None:
+        try:
+            names = pa_csv.open_csv(f).schema.names
+            f.seek(0)
+            # duplicate or empty headers need pandas' x / x.1 and 'Unnamed: N' renaming
+            if all(names) and len(set(names)) == len(names):
+                # pin all columns to string so barcodes keep leading zeros, as dtype=str does,
+                # and treat the same tokens as missing that pandas does
+                table = pa_csv.read_csv(f, convert_options=pa_csv.ConvertOptions(
+                    column_types={n: pa.string() for n in names},
+                    null_values=_CSV_NA_VALUES, strings_can_be_null=True))
+                return table.to_pandas()
+        except pa.ArrowInvalid:
+            f.seek(0)
+    return pd.read_csv(f, dtype=str, low_memory=False)
+
+def read_excel_text(f) -> pd.DataFrame:
+    """Read the first sheet of a workbook keeping every column as text."""
+    if _EXCEL_ENGINE is not None:
+        try:
+            return pd.read_excel(f, sheet_name=0, dtype=str, engine=_EXCEL_ENGINE)
+        except (ImportError, ValueError):
+            f.seek(0)
+    return pd.read_excel(f, sheet_name=0, dtype=str)
+
+# bounded caches: a shared server must not keep every distinct upload alive
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_frame(file_bytes: bytes, name: str) -> pd.DataFrame:
+    f = io.BytesIO(file_bytes)
+    try:
+        if name.lower().endswith('.csv'):
+            return read_csv_text(f)
+        return read_excel_text(f)
+    except Exception:
+        # fallback attempt
+        try:
+            f.seek(0)
+            return pd.read_csv(f, dtype=str, encoding='latin1', low_memory=False)
+        except Exception:
+            raise RuntimeError(f"Failed to read uploaded file: {name}")
+
+def _read_one(f) -> Optional[pd.DataFrame]:
+    if f is None:
+        return None
+    if isinstance(f, tuple):
+        name, data = f
+    else:
+        data = f.getvalue() if hasattr(f, 'getvalue') else f.read()
+        name = getattr(f, 'name', 'unknown')
+    return _load_frame(data, name)
+
 # --- core processor ---
 def process_combined_sheet(uploaded_files: List, params: dict) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Accepts:
-      - uploaded_files: list of file-like objects from Streamlit (CSV/XLSX)
+      - uploaded_files: list of (name, bytes) tuples or file-like objects from Streamlit (CSV/XLSX)
       - params: dict with DISPLAY_TARGET, BACKSTOCK_SAFETY, MIN_TRANSFER_QTY
 
     Returns:
       - final_df: aggregated per Key x Branch with suggested actions and flags
       - transfers_df: aggregated transfer lines (Key, From, To, Qty)
     """
-    # Read and concat uploaded files
+    # Read and concat uploaded files (parsing is I/O / decompression bound, so overlap it)
+    uploaded_files = list(uploaded_files)
     frames = []
-    for f in uploaded_files:
-        if f is None:
-            continue
-        name = getattr(f, "name", "").lower()
-        try:
-            if name.endswith('.csv'):
-                df = pd.read_csv(f, dtype=str, low_memory=False)
-            else:
-                df = pd.read_excel(f, sheet_name=0, dtype=str)
-        except Exception:
-            # fallback attempt
-            try:
-                f.seek(0)
-                df = pd.read_csv(f, dtype=str, encoding='latin1', low_memory=False)
-            except Exception:
-                raise RuntimeError(f"Failed to read uploaded file: {getattr(f, 'name', 'unknown')}")
-        frames.append(df)
+    if uploaded_files:
+        with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as ex:
+            frames = [df for df in ex.map(_read_one, uploaded_files) if df is not None]
 
     if not frames:
         return pd.DataFrame(), pd.DataFrame()
@@ -71,65 +141,68 @@ def process_combined_sheet(uploaded_files: List, params: dict) -> Tuple[pd.DataF
     MIN_TRANSFER_QTY = int(params.get('MIN_TRANSFER_QTY', 1))
 
     # Compute display and backstock
+    sq = df['SystemQty'].to_numpy(dtype=np.int64)
     # Display = min(system, DISPLAY_TARGET)
-    df['DisplayQty'] = df['SystemQty'].apply(lambda x: min(x, DISPLAY_TARGET))
-    df['Backstock'] = df['SystemQty'] - df['DisplayQty']
+    dq = np.minimum(sq, DISPLAY_TARGET)
+    bs = sq - dq
+    df['SystemQty'] = sq
+    df['DisplayQty'] = dq
+    df['Backstock'] = bs
 
     # New Need logic:
     # - Need_display: shortfall to reach display target
-    df['Need_display'] = df['DisplayQty'].apply(lambda x: max(DISPLAY_TARGET - x, 0))
+    need_display = np.maximum(DISPLAY_TARGET - dq, 0)
     # - Need_safety: shortfall to reach (DISPLAY_TARGET + BACKSTOCK_SAFETY) total stock
-    df['Need_safety'] = df['SystemQty'].apply(lambda x: max((DISPLAY_TARGET + BACKSTOCK_SAFETY) - x, 0))
+    need_safety = np.maximum((DISPLAY_TARGET + BACKSTOCK_SAFETY) - sq, 0)
     # - Final Need: max of the two (ensures low-total branches request stock to reach safe level)
-    df['Need'] = df[['Need_display', 'Need_safety']].max(axis=1).astype(int)
+    df['Need'] = np.maximum(need_display, need_safety)
 
     # Surplus: how much can be given away without breaking safety
-    df['Surplus'] = df['Backstock'].apply(lambda x: max(x - BACKSTOCK_SAFETY, 0)).astype(int)
+    df['Surplus'] = np.maximum(bs - BACKSTOCK_SAFETY, 0)
+
+    # int32 halves memory traffic downstream, but only when no Key x Branch sum can overflow it
+    qty_cols = ['SystemQty', 'DisplayQty', 'Backstock', 'Need', 'Surplus']
+    if max(np.abs(df[c].to_numpy()).sum() for c in qty_cols) <= np.iinfo(np.int32).max:
+        df[qty_cols] = df[qty_cols].astype(np.int32)
 
     # Expand by barcode (rows per barcode)
-    records = []
-    for _, r in df.iterrows():
-        bcs = split_barcodes(r.get('barcodes', ''))
-        if not bcs:
-            # include a row with empty barcode (still aggregated by Key later)
-            records.append({
-                'Branch': r.get('branch_name', ''),
-                'Product name': r.get('name_en', ''),
-                'Brand': r.get('brand', '') if 'brand' in r else '',
-                'Sale Price': r.get('sale_price', '') if 'sale_price' in r else '',
-                'Barcodes': '',
-                'Key': '',
-                'System Qty': int(r['SystemQty']),
-                'Display Qty': int(r['DisplayQty']),
-                'Backstock': int(r['Backstock']),
-                'Need': int(r['Need']),
-                'Surplus': int(r['Surplus'])
-            })
-        else:
-            for bc in bcs:
-                records.append({
-                    'Branch': r.get('branch_name', ''),
-                    'Product name': r.get('name_en', ''),
-                    'Brand': r.get('brand', '') if 'brand' in r else '',
-                    'Sale Price': r.get('sale_price', '') if 'sale_price' in r else '',
-                    'Barcodes': bc,
-                    'Key': normalize_key(bc),
-                    'System Qty': int(r['SystemQty']),
-                    'Display Qty': int(r['DisplayQty']),
-                    'Backstock': int(r['Backstock']),
-                    'Need': int(r['Need']),
-                    'Surplus': int(r['Surplus'])
-                })
-
-    rec = pd.DataFrame(records)
+    # collapse blank fragments ("a,,b", " ; ") before splitting so every source row
+    # yields its barcodes, or a single '' when it has none (still aggregated by Key later)
+    df['barcodes'] = (df['barcodes'].fillna('').astype(str).str.translate(_BC_TRANS)
+                      .str.replace(_BLANK_SEP_PAT, ',', regex=True).str.strip().str.strip(','))
+    rec = df.assign(Barcodes=df['barcodes'].str.split(',')).explode('Barcodes')
+    rec['Barcodes'] = rec['Barcodes'].str.strip()
+    # Key: digits of the barcode without leading zeros, else the lowercased barcode
+    # (vectorized counterpart of normalize_key; empty barcodes yield an empty Key),
+    # computed once per distinct barcode and broadcast back through the factorize codes
+    bc_codes, bc_uniques = pd.factorize(rec['Barcodes'])
+    bc_uniques = pd.Series(bc_uniques)
+    digits = bc_uniques.str.replace(_NON_DIGIT_PAT, '', regex=True).str.lstrip('0')
+    bc_keys = digits.mask(digits.eq(''), bc_uniques.str.strip().str.lower()).to_numpy()
+    # low-cardinality group keys: categorical codes make the groupby/merge hashing cheap
+    rec['Key'] = pd.Categorical(bc_keys[bc_codes])
+    rec['branch_name'] = rec['branch_name'].astype('category')
+
+    for c in ('brand', 'sale_price'):
+        if c not in rec.columns:
+            rec[c] = ''
+    rec = rec.rename(columns={
+        'branch_name': 'Branch',
+        'name_en': 'Product name',
+        'brand': 'Brand',
+        'sale_price': 'Sale Price',
+        'SystemQty': 'System Qty',
+        'DisplayQty': 'Display Qty',
+    })[['Branch', 'Product name', 'Brand', 'Sale Price', 'Barcodes', 'Key',
+        'System Qty', 'Display Qty', 'Backstock', 'Need', 'Surplus']]
+
     if rec.empty:
         return pd.DataFrame(), pd.DataFrame()
 
     # Aggregate per Key x Branch
-    agg = rec.groupby(['Key', 'Branch'], as_index=False).agg({
+    agg = rec.groupby(['Key', 'Branch'], as_index=False, observed=True, sort=False).agg({
         'Product name': 'first',
         'Brand': 'first',
-        'Barcodes': lambda x: ','.join(sorted(set(x.dropna().astype(str)))) if len(x.dropna()) > 0 else '',
         'Sale Price': 'first',
         'System Qty': 'sum',
         'Display Qty': 'sum',
@@ -137,101 +210,77 @@ def process_combined_sheet(uploaded_files: List, params: dict) -> Tuple[pd.DataF
         'Need': 'sum',
         'Surplus': 'sum'
     })
+    # Barcodes: sorted distinct barcodes per Key x Branch, comma-joined
+    # (groupby keeps row order within a group, so sorting by Barcodes alone is enough;
+    # a ','-prefixed string sum stays vectorized where ','.join runs once per group)
+    bc = rec.drop_duplicates(['Key', 'Branch', 'Barcodes']).sort_values('Barcodes')
+    barcodes = ((',' + bc['Barcodes']).groupby([bc['Key'], bc['Branch']], observed=True, sort=False)
+                .sum().str[1:].reset_index())
+    agg = agg.merge(barcodes, on=['Key', 'Branch'], how='left')
 
     # Greedy transfer allocation (no branch priority)
-    transfers = []
-    for key in agg['Key'].unique():
-        sub = agg[agg['Key'] == key].copy()
-        # prepare mutable sources/dests lists
-        sources = [{'branch': b, 'surplus': int(s)} for b, s in zip(sub['Branch'], sub['Surplus']) if int(s) >= MIN_TRANSFER_QTY]
-        dests = [{'branch': b, 'need': int(n)} for b, n in zip(sub['Branch'], sub['Need']) if int(n) >= 1]
-        for d in dests:
-            need = d['need']
-            for s in sources:
-                if s['surplus'] <= 0:
-                    continue
-                qty = min(s['surplus'], need)
-                if qty >= MIN_TRANSFER_QTY:
-                    transfers.append({'Key': key, 'From': s['branch'], 'To': d['branch'], 'Qty': int(qty)})
-                    s['surplus'] -= qty
-                    need -= qty
-                if need <= 0:
-                    break
-
-    transfers_df = pd.DataFrame(transfers)
+    # rows of one Key must be contiguous and in branch order for the allocator
+    agg = agg.sort_values(['Key', 'Branch'], ignore_index=True)
+    key_arr = agg['Key'].to_numpy()
+    _, group_starts = np.unique(agg['Key'].cat.codes.to_numpy(), return_index=True)
+    group_starts = np.sort(group_starts)
+    group_ends = np.append(group_starts[1:], len(agg))
+    src_idx, dst_idx, qty = allocate(group_starts, group_ends,
+                                     agg['Surplus'].to_numpy(dtype=np.int64),
+                                     agg['Need'].to_numpy(dtype=np.int64),
+                                     MIN_TRANSFER_QTY)
+    branch_arr = agg['Branch'].to_numpy()
+    transfers_df = pd.DataFrame({'Key': key_arr[src_idx], 'From': branch_arr[src_idx],
+                                 'To': branch_arr[dst_idx], 'Qty': qty}).astype({'Key': str, 'From': str, 'To': str})
 
     # Annotate agg with suggested actions and partners
-    agg['Suggested Action'] = ''
-    agg['Suggested Transfer Qty'] = 0
-    agg['Suggested Partner'] = ''
-
-    if not transfers_df.empty:
-        for _, t in transfers_df.iterrows():
-            mask_src = (agg['Key'] == t['Key']) & (agg['Branch'] == t['From'])
-            agg.loc[mask_src, 'Suggested Action'] = agg.loc[mask_src, 'Suggested Action'].apply(
-                lambda x: (x + f"Transfer to {t['To']} x{t['Qty']}; ") if str(x) != '' else (f"Transfer to {t['To']} x{t['Qty']}; "))
-            agg.loc[mask_src, 'Suggested Transfer Qty'] += int(t['Qty'])
-            agg.loc[mask_src, 'Suggested Partner'] = agg.loc[mask_src, 'Suggested Partner'].apply(
-                lambda x: (x + f"{t['To']},") if str(x) != '' else t['To'])
-
-            mask_dst = (agg['Key'] == t['Key']) & (agg['Branch'] == t['To'])
-            agg.loc[mask_dst, 'Suggested Action'] = agg.loc[mask_dst, 'Suggested Action'].apply(
-                lambda x: (x + f"Receive from {t['From']} x{t['Qty']}; ") if str(x) != '' else (f"Receive from {t['From']} x{t['Qty']}; "))
-            agg.loc[mask_dst, 'Suggested Transfer Qty'] += int(t['Qty'])
-            agg.loc[mask_dst, 'Suggested Partner'] = agg.loc[mask_dst, 'Suggested Partner'].apply(
-                lambda x: (x + f"{t['From']},") if str(x) != '' else t['From'])
+    # (string 'sum' concatenates per group vectorized; partners get a ',' prefix dropped afterwards)
+    qty_txt = transfers_df['Qty'].astype(str)
+    src = (transfers_df.assign(txt='Transfer to ' + transfers_df['To'] + ' x' + qty_txt + '; ',
+                               partner=',' + transfers_df['To'])
+           .groupby(['Key', 'From'], as_index=False, observed=True, sort=False)
+           .agg(src_action=('txt', 'sum'), src_qty=('Qty', 'sum'), src_partner=('partner', 'sum'))
+           .rename(columns={'From': 'Branch'}))
+    dst = (transfers_df.assign(txt='Receive from ' + transfers_df['From'] + ' x' + qty_txt + '; ',
+                               partner=',' + transfers_df['From'])
+           .groupby(['Key', 'To'], as_index=False, observed=True, sort=False)
+           .agg(dst_action=('txt', 'sum'), dst_qty=('Qty', 'sum'), dst_partner=('partner', 'sum'))
+           .rename(columns={'To': 'Branch'}))
+    src['src_partner'] = src['src_partner'].str[1:]
+    dst['dst_partner'] = dst['dst_partner'].str[1:]
+    agg = agg.merge(src, on=['Key', 'Branch'], how='left').merge(dst, on=['Key', 'Branch'], how='left')
+
+    agg['Suggested Action'] = agg['src_action'].fillna('') + agg['dst_action'].fillna('')
+    agg['Suggested Transfer Qty'] = (agg['src_qty'].fillna(0) + agg['dst_qty'].fillna(0)).astype(int)
+    src_partner = agg['src_partner'].fillna('')
+    dst_partner = agg['dst_partner'].fillna('')
+    agg['Suggested Partner'] = src_partner.str.cat(dst_partner, sep=',').where(
+        src_partner.ne('') & dst_partner.ne(''), src_partner + dst_partner)
+    agg = agg.drop(columns=['src_action', 'src_qty', 'src_partner', 'dst_action', 'dst_qty', 'dst_partner'])
 
     # Unified Sku Flag
-    def unified_flag(row):
-        sa = str(row.get('Suggested Action', '')).strip()
-        if sa != '':
-            return sa.rstrip('; ')
-        if int(row.get('Surplus', 0)) > 0 and int(row.get('Need', 0)) == 0:
-            return 'Overstock — keep or transfer'
-        if int(row.get('Need', 0)) > 0 and int(row.get('Surplus', 0)) == 0:
-            return 'Need stock — consider PO'
-        return 'Balanced'
-
-    agg['Sku Flag'] = agg.apply(unified_flag, axis=1)
+    sa = agg['Suggested Action'].str.strip()
+    has_action = sa.ne('')
+    is_overstock = (agg['Surplus'] > 0) & (agg['Need'] == 0)
+    is_need = (agg['Need'] > 0) & (agg['Surplus'] == 0)
+    agg['Sku Flag'] = np.select(
+        [has_action, is_overstock, is_need],
+        [sa.str.rstrip('; '), 'Overstock — keep or transfer', 'Need stock — consider PO'],
+        default='Balanced')
 
     # Action column: human instruction derived from Suggested Action or Sku Flag
-    def action_text(row):
-        sa = str(row.get('Suggested Action', '')).strip()
-        if sa != '':
-            # prefer structured instructions
-            # e.g. "Transfer to BR xN" -> "Prepare Transfer — Move N units to BR"
-            parts = sa.split(';')
-            # take first instruction only for single action text
-            inst = parts[0].strip() if parts else sa
-            if inst.lower().startswith('transfer to '):
-                # format: Transfer to <Branch> x<QTY>
-                try:
-                    left, qty_part = inst.rsplit(' x', 1)
-                    branch = left.replace('Transfer to ', '').strip()
-                    qty = qty_part.strip()
-                    return f"Prepare Transfer — Move {qty} units to {branch}"
-                except Exception:
-                    return f"Prepare Transfer — {inst}"
-            if inst.lower().startswith('receive from '):
-                try:
-                    left, qty_part = inst.rsplit(' x', 1)
-                    branch = left.replace('Receive from ', '').strip()
-                    qty = qty_part.strip()
-                    return f"Prepare Receiving — Expect {qty} units from {branch}"
-                except Exception:
-                    return f"Prepare Receiving — {inst}"
-            return sa
-        # no suggested action -> map flags to actions
-        flag = row.get('Sku Flag', '')
-        if flag.startswith('Overstock'):
-            return 'Review Overstock — Consider markdown or future transfer'
-        if flag.startswith('Need stock'):
-            return 'Create PO — Replenish stock for this SKU'
-        if flag == 'Balanced':
-            return 'No action needed'
-        return 'Review'
-
-    agg['Action'] = agg.apply(action_text, axis=1)
+    # take first instruction only, e.g. "Transfer to BR xN" -> "Prepare Transfer — Move N units to BR"
+    inst = sa.str.split(';', n=1).str[0].str.strip()
+    parts = inst.str.extract(_INSTRUCTION_PAT)
+    branch, qty = parts[1].fillna(''), parts[2].fillna('')
+    agg['Action'] = np.select(
+        [parts[0].eq('Transfer to'), parts[0].eq('Receive from'), has_action, is_overstock, is_need],
+        ['Prepare Transfer — Move ' + qty + ' units to ' + branch,
+         'Prepare Receiving — Expect ' + qty + ' units from ' + branch,
+         sa,
+         'Review Overstock — Consider markdown or future transfer',
+         'Create PO — Replenish stock for this SKU'],
+        default='No action needed')
 
     # Final ordering and column names
     final_cols = ['Product name', 'Barcodes', 'Sale Price', 'Branch', 'System Qty', 'Display Qty',
@@ -244,5 +293,21 @@ def process_combined_sheet(uploaded_files: List, params: dict) -> Tuple[pd.DataF
             final[c] = '' if final[c].dtype == object else 0
 
     final = final[final_cols].copy()
+    # categorical group keys back to plain strings for display/export
+    final['Branch'] = final['Branch'].astype(str)
+    # single deterministic display order instead of sorting inside every groupby
+    final = final.sort_values(['Product name', 'Branch'], kind='stable', ignore_index=True)
 
     return final, transfers_df
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _process_cached(files: Tuple[Tuple[str, bytes], ...], params_items: Tuple) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    return process_combined_sheet(list(files), dict(params_items))
+
+def process_combined_sheet_cached(files: List[Tuple[str, bytes]], params: dict) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Same as process_combined_sheet, memoized across Streamlit reruns on the
+    uploaded (name, bytes) pairs and the parameter values.
+    """
+    return _process_cached(tuple(files), tuple(sorted(params.items())))
@@ -4,6 +4,37 @@ import pandas as pd
 import io
 from datetime import datetime
 
+try:
+    import xlsxwriter
+except ImportError:  # fall back to pandas + openpyxl
+    xlsxwriter = None
+
+def build_excel(sheets: dict) -> bytes:
+    """
+    Serialize {sheet_name: DataFrame} to xlsx bytes.
+
+    With xlsxwriter, rows are streamed in constant_memory mode. pandas'
+    to_excel writes column by column, which that mode cannot accept, so
+    rows are written directly.
+    """
+    with io.BytesIO() as buffer:
+        if xlsxwriter is None:
+            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+                for sheet_name, df in sheets.items():
+                    df.to_excel(writer, index=False, sheet_name=sheet_name)
+            return buffer.getvalue()
+
+        workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+        for sheet_name, df in sheets.items():
+            ws = workbook.add_worksheet(sheet_name)
+            ws.write_row(0, 0, [str(c) for c in df.columns])
+            # NaN cannot be written as a number; write blanks instead
+            values = df.astype(object).where(df.notna(), None)
+            for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+                ws.write_row(r, 0, row)
+        workbook.close()
+        return buffer.getvalue()
+
 def render_ui(process_fn):
     st.header('Upload combined sheet (or multiple branch files)')
     st.markdown(
@@ -39,8 +70,9 @@ def render_ui(process_fn):
             'MIN_TRANSFER_QTY': int(MIN_TRANSFER_QTY)
         }
 
+        files = [(f.name, f.getvalue()) for f in uploaded]
         try:
-            final, transfers = process_fn(uploaded, params)
+            final, transfers = process_fn(files, params)
         except Exception as e:
             st.error(f'Processing failed: {e}')
             return
@@ -63,18 +95,15 @@ def render_ui(process_fn):
         except Exception:
             csv_bytes = final.to_csv(index=False).encode()
 
-        with io.BytesIO() as buffer:
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                final.to_excel(writer, index=False, sheet_name='BRANCH_SUGGESTIONS')
-                if not transfers.empty:
-                    transfers.to_excel(writer, index=False, sheet_name='TRANSFERS')
-            excel_bytes = buffer.getvalue()
+        sheets = {'BRANCH_SUGGESTIONS': final}
+        if not transfers.empty:
+            sheets['TRANSFERS'] = transfers
 
         csv_name = 'branch_transfer_report_{}.csv'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
         xlsx_name = 'branch_transfer_report_{}.xlsx'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'))
 
         st.download_button('Download report — CSV', data=csv_bytes, file_name=csv_name)
-        st.download_button('Download report — Excel', data=excel_bytes, file_name=xlsx_name)
+        st.download_button('Download report — Excel', data=lambda: build_excel(sheets), file_name=xlsx_name)
 
         st.markdown('---')
         st.info(
@@ -1,6 +1,6 @@
 # streamlit_app.py
 import streamlit as st
-from modules.processor import process_combined_sheet
+from modules.processor import process_combined_sheet_cached
 from modules.ui import render_ui
 
 st.set_page_config(page_title="Nard Transfer Assistant", layout="wide")
@@ -8,4 +8,4 @@ st.set_page_config(page_title="Nard Transfer Assistant", layout="wide")
 st.title("Slot-X Stock Display,Storage,Transfer Assistant")
 st.markdown("Upload a combined stock sheet (or multiple branch files). The app computes display/backstock/need/surplus per branch and suggests transfers.")
 
-render_ui(process_combined_sheet)
+render_ui(process_combined_sheet_cached)
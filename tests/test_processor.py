@@ -0,0 +1,59 @@
+# tests/test_processor.py
+import io
+
+import numpy as np
+import pandas as pd
+
+from modules._alloc import _allocate, allocate
+from modules.processor import process_combined_sheet
+
+
+def _run(fn, surplus, need, min_qty):
+    starts = np.array([0], dtype=np.int64)
+    ends = np.array([len(surplus)], dtype=np.int64)
+    src, dst, qty = fn(starts, ends, np.array(surplus, dtype=np.int64),
+                       np.array(need, dtype=np.int64), min_qty)
+    return list(zip(src.tolist(), dst.tolist(), qty.tolist()))
+
+
+def test_allocate_skips_zero_surplus_when_min_qty_is_not_positive():
+    # row 0 has nothing to give; a min_qty of 0 must not emit zero-unit transfers
+    for fn in (_allocate, allocate):
+        for min_qty in (0, -1):
+            assert _run(fn, [0, 3], [3, 0], min_qty) == [(1, 0, 3)]
+
+
+def test_process_combined_sheet_min_transfer_qty_zero():
+    df = pd.DataFrame({'name_en': 'p', 'branch_name': ['A', 'B'], 'barcodes': '1',
+                       'available_quantity': ['0', '6']})
+    params = {'DISPLAY_TARGET': 3, 'BACKSTOCK_SAFETY': 0, 'MIN_TRANSFER_QTY': 0}
+    _, transfers = process_combined_sheet([('stock.csv', df.to_csv(index=False).encode())], params)
+    assert transfers[['From', 'To', 'Qty']].values.tolist() == [['B', 'A', 3]]
+
+
+def test_process_combined_sheet_large_quantities_do_not_wrap():
+    df = pd.DataFrame({'name_en': 'p', 'branch_name': ['A', 'B'], 'barcodes': '1',
+                       'available_quantity': ['3000000000', '0']})
+    final, transfers = process_combined_sheet([('stock.csv', df.to_csv(index=False).encode())], {})
+    a = final[final['Branch'] == 'A'].iloc[0]
+    assert a['System Qty'] == 3000000000
+    assert a['Need'] == 0
+    assert transfers[['From', 'To', 'Qty']].values.tolist() == [['A', 'B', 3]]
+
+
+def test_process_combined_sheet_accepts_plain_file_handles(tmp_path):
+    path = tmp_path / 'stock.csv'
+    pd.DataFrame({'name_en': 'p', 'branch_name': ['A', 'B'], 'barcodes': '1',
+                  'available_quantity': ['0', '6']}).to_csv(path, index=False)
+    with open(path, 'rb') as f:
+        final, _ = process_combined_sheet([f], {})
+    assert sorted(final['Branch']) == ['A', 'B']
+
+
+def test_process_combined_sheet_strips_unicode_whitespace_around_separators():
+    # NBSP / ideographic space show up next to separators in Excel exports
+    df = pd.DataFrame({'name_en': 'p', 'branch_name': ['A', 'A', 'B'],
+                       'barcodes': ['abc;\xa0xyz', 'xyz', 'abc;\xa0;　xyz'],
+                       'available_quantity': ['1', '1', '1']})
+    final, _ = process_combined_sheet([('stock.csv', df.to_csv(index=False).encode())], {})
+    assert sorted(final['Barcodes']) == ['abc', 'abc', 'xyz', 'xyz']